@@ -3,9 +3,9 @@
 __author__ = """kcjerrell"""
 __version__ = "1.9.3"
 
-from .src.util import CancelRequest, Settings
+from .src.util import CancelRequests, Settings
 
-cancel_request = CancelRequest()
+cancel_requests = CancelRequests()
 settings = Settings()
 
 from .src import routes
@@ -0,0 +1,71 @@
+"""
+Compares raw and fpzip compressed request tensors: bytes sent against the
+CPU time spent compressing. Run from the repository root:
+
+    python scripts/bench_upload_compression.py [image ...]
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+from src.image_handlers import (  # noqa: E402
+    compress_tensor,
+    convert_image_for_request,
+    get_image_data,
+)
+
+default_images = [
+    "example_workflows/Text to Image.jpg",
+    "tests/workflows/depth.jpg",
+    "tests/workflows/style.jpg",
+]
+sizes = [512, 1024, 2048]
+
+
+def load_image(path):
+    image = np.array(Image.open(path).convert("RGB")).astype(np.float32) / 255.0
+    return torch.from_numpy(image).unsqueeze(0)
+
+
+def bench(path, size, control_type=None):
+    tensor = convert_image_for_request(
+        load_image(path), control_type, width=size, height=size
+    )
+
+    start = time.process_time()
+    compressed = compress_tensor(tensor)
+    compress_time = time.process_time() - start
+
+    start = time.process_time()
+    restored = get_image_data(compressed)
+    decompress_time = time.process_time() - start
+
+    assert np.array_equal(restored, get_image_data(tensor)), "not lossless"
+
+    raw = len(tensor)
+    saved = raw - len(compressed)
+    print(
+        f"{os.path.basename(path):<20} {control_type or 'image':<6} {size:>5} "
+        f"{raw / 1e6:>8.2f} MB {len(compressed) / 1e6:>8.2f} MB "
+        f"{saved / raw:>6.1%} {compress_time * 1000:>8.1f} ms "
+        f"{decompress_time * 1000:>8.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    paths = sys.argv[1:] or default_images
+    print(
+        f"{'image':<20} {'type':<6} {'size':>5} {'raw':>11} {'fpzip':>11} "
+        f"{'saved':>6} {'compress':>11} {'decompress':>11}"
+    )
+    for path in paths:
+        for size in sizes:
+            bench(path, size)
+            bench(path, size, "depth")
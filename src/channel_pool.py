@@ -0,0 +1,160 @@
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager
+
+import grpc
+import grpc.aio
+
+from .credentials import credentials
+
+IDLE_TIMEOUT = 300
+CLOSE_GRACE = 5
+
+
+def get_aio_channel(server, port, use_tls):
+    options = [
+        ["grpc.max_send_message_length", -1],
+        ["grpc.max_receive_message_length", -1],
+    ]
+    if use_tls and credentials is not None:
+        return grpc.aio.secure_channel(f"{server}:{port}", credentials, options=options)
+    return grpc.aio.insecure_channel(f"{server}:{port}", options=options)
+
+
+class PooledChannel:
+    def __init__(self, key, channel: grpc.aio.Channel):
+        self.key = key
+        self.channel = channel
+        self.in_use = 0
+        self.last_used = time.monotonic()
+        self.failures = 0
+        # replaced by a new channel, closed once the calls using it are done
+        self.retired = False
+
+    @property
+    def state(self) -> grpc.ChannelConnectivity:
+        return self.channel.get_state(try_to_connect=False)
+
+    @property
+    def healthy(self):
+        return self.failures == 0 and self.state not in [
+            grpc.ChannelConnectivity.TRANSIENT_FAILURE,
+            grpc.ChannelConnectivity.SHUTDOWN,
+        ]
+
+    def is_idle(self, now):
+        return self.in_use == 0 and now - self.last_used > IDLE_TIMEOUT
+
+
+class ChannelPool:
+    """
+    Keeps one gRPC channel per (server, port, use_tls) open between requests,
+    so generations and file lookups reuse a warm connection instead of paying
+    for the TCP, TLS and HTTP/2 setup each time.
+
+    aio channels only work on the event loop that created them, and ComfyUI
+    runs each prompt on a loop of its own. So the channels all live on one
+    loop in a background thread, and code using them goes through run()
+    """
+
+    def __init__(self):
+        self._channels: dict[tuple, PooledChannel] = {}
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._loop.run_forever,
+                    name="dt_grpc_channels",
+                    daemon=True,
+                ).start()
+            return self._loop
+
+    async def run(self, coroutine):
+        """
+        Runs coroutine on the channel loop and waits for it from the calling
+        loop. Cancelling the caller cancels the coroutine as well
+        """
+        loop = self.loop
+        if asyncio.get_running_loop() is loop:
+            return await coroutine
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(coroutine, loop)
+        )
+
+    def _acquire(self, server, port, use_tls) -> PooledChannel:
+        key = (server, str(port), bool(use_tls))
+        entry = self._channels.get(key)
+
+        if entry is not None and not entry.healthy:
+            self._discard(entry)
+            entry = None
+
+        if entry is None:
+            entry = PooledChannel(key, get_aio_channel(server, port, use_tls))
+            self._channels[key] = entry
+
+        entry.in_use += 1
+        return entry
+
+    def _release(self, entry: PooledChannel):
+        entry.in_use -= 1
+        entry.last_used = time.monotonic()
+        if entry.retired and entry.in_use == 0:
+            asyncio.ensure_future(entry.channel.close(CLOSE_GRACE))
+
+    def _discard(self, entry: PooledChannel):
+        if self._channels.get(entry.key) is entry:
+            del self._channels[entry.key]
+        entry.retired = True
+        # calls still using the channel keep it open until they are released
+        if entry.in_use == 0:
+            asyncio.ensure_future(entry.channel.close(CLOSE_GRACE))
+
+    def evict_idle(self):
+        now = time.monotonic()
+        for entry in list(self._channels.values()):
+            if entry.is_idle(now):
+                self._discard(entry)
+
+    @asynccontextmanager
+    async def connect(self, server, port, use_tls):
+        """
+        A pooled channel to the server. Only usable on the channel loop, so
+        wrap the code calling this in run()
+        """
+        if asyncio.get_running_loop() is not self._loop:
+            raise Exception("Pooled gRPC channels must be used through run()")
+
+        self.evict_idle()
+        entry = self._acquire(server, port, use_tls)
+        try:
+            yield entry.channel
+            entry.failures = 0
+        except grpc.aio.AioRpcError as e:
+            if e.code() == grpc.StatusCode.UNAVAILABLE:
+                entry.failures += 1
+            raise
+        finally:
+            self._release(entry)
+
+    async def _close_all(self, grace):
+        entries = list(self._channels.values())
+        self._channels.clear()
+        await asyncio.gather(
+            *(entry.channel.close(grace) for entry in entries),
+            return_exceptions=True,
+        )
+
+    async def close(self, grace=CLOSE_GRACE):
+        if self._loop is None or self._loop.is_closed():
+            return
+        await self.run(self._close_all(grace))
+
+
+channel_pool = ChannelPool()
@@ -0,0 +1,37 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from .. import settings
+
+# numpy and torch release the GIL for the heavy array work, so a thread pool
+# is enough to keep the event loop free without pickling tensors across
+# processes
+_executor: ThreadPoolExecutor | None = None
+_executor_workers = 0
+
+
+def get_codec_executor() -> ThreadPoolExecutor:
+    global _executor, _executor_workers
+
+    workers = max(1, settings.codec_workers)
+    if _executor is None or _executor_workers != workers:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        _executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="dt_grpc_codec"
+        )
+        _executor_workers = workers
+
+    return _executor
+
+
+async def run_codec(func, *args, **kwargs):
+    """
+    Runs an encode or decode function on the codec thread pool, so the
+    ComfyUI event loop stays responsive while it works
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_codec_executor(), functools.partial(func, *args, **kwargs)
+    )
@@ -0,0 +1,77 @@
+import hashlib
+
+from .codec_executor import run_codec
+from .model_catalog import model_catalog
+
+# digests remembered per server before the record is reset
+MAX_SENT_CONTENTS = 1024
+
+
+def sha256_digest(blob: bytes) -> bytes:
+    return hashlib.sha256(blob).digest()
+
+
+class ContentUpload:
+    """
+    Collects the tensors for one request. Each tensor is replaced by its
+    sha256 digest, and only the ones the server hasn't been sent yet go out
+    in the request's contents
+    """
+
+    def __init__(self, sent: set[bytes]):
+        self.sent = sent
+        self.contents: dict[bytes, bytes] = {}
+        # whether any tensor was left out because the server already has it
+        self.omitted = False
+
+    async def add(self, blob: bytes | None) -> bytes | None:
+        if blob is None:
+            return None
+
+        digest = await run_codec(sha256_digest, blob)
+        if digest in self.sent:
+            self.omitted = True
+        else:
+            self.contents[digest] = blob
+
+        return digest
+
+    def complete(self):
+        """
+        Call once the server has accepted the request, so later requests can
+        refer to these contents without sending them again
+        """
+        if len(self.sent) + len(self.contents) > MAX_SENT_CONTENTS:
+            self.sent.clear()
+        self.sent.update(self.contents.keys())
+
+
+class ContentStore:
+    """
+    Remembers which contents have been sent to each server
+    """
+
+    def __init__(self):
+        self._sent: dict[tuple, set[bytes]] = {}
+
+    @staticmethod
+    def _key(server, port, use_tls):
+        return (
+            server,
+            str(port),
+            bool(use_tls),
+            model_catalog.server_identifier(server, port, use_tls),
+        )
+
+    def upload(self, server, port, use_tls) -> ContentUpload:
+        key = self._key(server, port, use_tls)
+        return ContentUpload(self._sent.setdefault(key, set()))
+
+    def forget(self, server, port, use_tls):
+        key = (server, str(port), bool(use_tls))
+        for sent_key in list(self._sent.keys()):
+            if sent_key[:3] == key:
+                del self._sent[sent_key]
+
+
+content_store = ContentStore()
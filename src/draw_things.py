@@ -1,93 +1,380 @@
-import base64
+import asyncio
+import copy
 import json
+import time
 
 import comfy.utils
 import flatbuffers
 import grpc
 import grpc.aio
-import numpy as np
 import torch
 from comfy.cli_args import args
-from google.protobuf.json_format import MessageToJson
-from PIL import Image
 
-from .. import cancel_request, settings
-from .config import build_config
-from .credentials import credentials
-from .data_types import DrawThingsLists, HintStack, ModelsInfo, UpscalerInfo
+from .. import settings
+from .channel_pool import channel_pool
+from .codec_executor import run_codec
+from .config import ModelVersion, build_config
+from .content_store import ContentUpload, content_store
+from .data_types import DrawThingsLists, HintStack, ModelsInfo
 from .generated import imageService_pb2, imageService_pb2_grpc
 from .image_handlers import (
+    compress_tensor,
     convert_image_for_request,
+    convert_images_for_request,
     convert_mask_for_request,
-    convert_response_image,
     decode_preview,
+    decode_response_image,
+    read_image_shape,
 )
-from .util import try_parse_int
+from .jobs import Job, jobs
+from .metrics import RequestMetrics
+from .model_catalog import model_catalog
+from .scheduler import BACKGROUND, INTERACTIVE
+from .server_pool import (
+    ENDPOINT_FAILURE_CODES,
+    Endpoint,
+    EndpointUnavailable,
+    ServerPool,
+    get_server_pool,
+)
+from .tiling import fit_inputs, stitch_tiles, tile_canvas, tile_inputs
+from .tracing import NULL_TRACE, Trace, tracer
+from .util import CancelToken, try_parse_int
 
 MAX_PREVIEW_RESOLUTION = try_parse_int(args.preview_size) or 512
 
 
-async def get_files(server, port, use_tls) -> ModelsInfo:
-    async with get_aio_channel(server, port, use_tls) as channel:
-        stub = imageService_pb2_grpc.ImageGenerationServiceStub(channel)
-        response = await stub.Echo(imageService_pb2.EchoRequest(name="ComfyUI"))
-        response_json = json.loads(MessageToJson(response))
-        override = dict(response_json["override"])
-        model_info = {
-            k: json.loads(str(base64.b64decode(override[k]), "utf8"))
-            for k in override.keys()
-        }
-
-        if "upscalers" not in model_info:
-            official = [
-                "realesrgan_x2plus_f16.ckpt",
-                "realesrgan_x4plus_f16.ckpt",
-                "realesrgan_x4plus_anime_6b_f16.ckpt",
-                "esrgan_4x_universal_upscaler_v2_sharp_f16.ckpt",
-                "remacri_4x_f16.ckpt",
-                "4x_ultrasharp_f16.ckpt",
-            ]
-            model_info["upscalers"] = [UpscalerInfo(file=f, name=f) for f in official]
-
-        return ModelsInfo(
-            models=model_info["models"],
-            controlNets=model_info["controlNets"],
-            loras=model_info["loras"],
-            upscalers=model_info["upscalers"],
-            textualInversions=model_info["textualInversions"],
+async def get_files(server, port, use_tls, refresh=False) -> ModelsInfo:
+    # with several servers, the model list comes from the first one that answers
+    error = None
+    for endpoint in get_server_pool(server, port, use_tls).endpoints:
+        try:
+            return await model_catalog.get(
+                endpoint.server, endpoint.port, endpoint.use_tls, refresh=refresh
+            )
+        except Exception as e:
+            error = e
+    raise error
+
+
+async def dt_sampler(inputs: dict, cancel_token: CancelToken | None = None):
+    trace = tracer.start(f"DrawThingsSampler {inputs.get('unique_id')}")
+    try:
+        return await sample(inputs, cancel_token or CancelToken(), trace)
+    finally:
+        tracer.finish(trace)
+
+
+async def sample(inputs: dict, cancel_token: CancelToken, trace: Trace):
+    pool = get_server_pool(
+        inputs.get("server"), inputs.get("port"), inputs.get("use_tls")
+    )
+
+    if should_distribute_tiles(inputs, pool):
+        return (await generate_tiled(inputs, pool, cancel_token, trace),)
+
+    request = await prepare_request(inputs, trace)
+    progress = comfy.utils.ProgressBar(request.config.steps, inputs["unique_id"])
+    version = inputs.get("version")
+
+    batch_count = request.config.batchCount
+    if not settings.batch_fan_out or batch_count < 2 or len(pool.endpoints) < 2:
+        images = await generate_on_pool(
+            pool, request, progress, version, cancel_token, trace
         )
+        return (images,)
+
+    # each image of the batch count becomes its own request, so the pool can
+    # spread them over every server
+    fan_out = FanOutProgress(progress, batch_count)
+    batches = await gather_or_cancel(
+        generate_on_pool(
+            pool,
+            request.for_batch_index(index),
+            fan_out.part(index),
+            version,
+            cancel_token,
+            trace,
+        )
+        for index in range(batch_count)
+    )
 
+    return (torch.cat(batches),)
+
+
+def should_distribute_tiles(inputs: dict, pool: ServerPool):
+    # tiles are generated independently, so without an image to start from
+    # they wouldn't agree with each other. Those are left to the server's own
+    # tiled diffusion
+    return (
+        settings.distributed_tiling
+        and inputs.get("tiled_diffusion")
+        and inputs.get("image") is not None
+        and len(pool.endpoints) > 1
+        and (
+            inputs.get("width", 0) > inputs.get("diffusion_tile_width", 0)
+            or inputs.get("height", 0) > inputs.get("diffusion_tile_height", 0)
+        )
+    )
 
-def get_aio_channel(server, port, use_tls):
-    options = [
-        ["grpc.max_send_message_length", -1],
-        ["grpc.max_receive_message_length", -1],
-    ]
-    if use_tls and credentials is not None:
-        return grpc.aio.secure_channel(f"{server}:{port}", credentials, options=options)
-    return grpc.aio.insecure_channel(f"{server}:{port}", options=options)
 
+async def generate_tiled(
+    inputs: dict,
+    pool: ServerPool,
+    cancel_token: CancelToken,
+    trace: Trace = NULL_TRACE,
+):
+    """
+    Splits the canvas into overlapping tiles using the diffusion_tile_*
+    inputs, generates each tile as an img2img request somewhere in the pool,
+    and blends them back together
+    """
+    width, height = inputs["width"], inputs["height"]
+    overlap = inputs.get("diffusion_tile_overlap", 64)
+    tiles = tile_canvas(
+        width,
+        height,
+        inputs["diffusion_tile_width"],
+        inputs["diffusion_tile_height"],
+        overlap,
+    )
 
-async def dt_sampler(inputs: dict):
-    server, port, use_tls = (
-        inputs.get("server"),
-        inputs.get("port"),
-        inputs.get("use_tls"),
+    progress = comfy.utils.ProgressBar(inputs.get("steps", 1), inputs["unique_id"])
+    fan_out = FanOutProgress(progress, len(tiles))
+
+    with trace.span("fit inputs to canvas"):
+        fitted = await run_codec(fit_inputs, inputs, width, height)
+
+    # only as many tiles are encoded as the pool can run at once, so a large
+    # canvas doesn't hold every encoded tile in memory while they wait
+    slots = asyncio.Semaphore(len(pool.endpoints) * settings.server_concurrency)
+
+    async def generate_tile(index, tile):
+        async with slots:
+            request = await prepare_request(tile_inputs(fitted, tile), trace)
+            request.lane = BACKGROUND
+            return await generate_on_pool(
+                pool,
+                request,
+                fan_out.part(index),
+                inputs.get("version"),
+                cancel_token,
+                trace,
+            )
+
+    images = await gather_or_cancel(
+        generate_tile(index, tile) for index, tile in enumerate(tiles)
     )
+
+    with trace.span("stitch tiles", tiles=len(tiles)):
+        return await run_codec(stitch_tiles, tiles, images, width, height, overlap)
+
+
+async def gather_or_cancel(coroutines):
+    """
+    Runs the coroutines together, cancelling the rest as soon as one fails
+    """
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+async def generate_on_pool(
+    pool: ServerPool,
+    request: "GenerationRequest",
+    progress,
+    version,
+    cancel_token: CancelToken,
+    trace: Trace = NULL_TRACE,
+) -> torch.Tensor:
+    """
+    Generates a request on an endpoint picked from the pool, moving it to
+    another endpoint if it fails before sampling starts
+    """
+    with jobs.track(request, cancel_token) as job:
+        tried = []
+        while True:
+            job.cancel_token.raise_if_canceled()
+            queued_at = time.perf_counter()
+            try:
+                async with pool.acquire(
+                    request.models,
+                    exclude=tried,
+                    cancel_token=job.cancel_token,
+                    lane=request.lane,
+                ) as endpoint:
+                    trace.add_span(
+                        "queued",
+                        queued_at,
+                        time.perf_counter(),
+                        f"job {job.id}",
+                        endpoint=str(endpoint),
+                    )
+                    job.start(endpoint)
+                    return await channel_pool.run(
+                        generate(endpoint, request, progress, version, job, trace)
+                    )
+            except EndpointUnavailable as e:
+                # nothing was generated yet, so another endpoint can take it over
+                tried.append(e.endpoint)
+                if not pool.has_fallback(tried):
+                    raise e.error
+                job.requeue()
+                print(f"DrawThings-gRPC: {e}, trying another server")
+
+
+def derive_seed(seed, index):
+    """
+    The seed of the image at index in a batch count. Draw Things adds one to
+    the seed for each image, wrapping as a uint32
+    """
+    return (seed + index) & 0xFFFFFFFF
+
+
+class FanOutProgress:
+    """
+    Shows the progress of a batch split over several requests as one
+    progress bar
+    """
+
+    def __init__(self, progress, count):
+        self.progress = progress
+        self.values = [0] * count
+        self.totals = [0] * count
+
+    def part(self, index):
+        return FanOutProgress.Part(self, index)
+
+    def update(self, index, value, total, preview):
+        self.values[index] = value
+        self.totals[index] = total
+        self.progress.update_absolute(
+            sum(self.values), total=sum(self.totals), preview=preview
+        )
+
+    class Part:
+        def __init__(self, fan_out, index):
+            self.fan_out = fan_out
+            self.index = index
+
+        def update_absolute(self, value, total=None, preview=None):
+            self.fan_out.update(self.index, value, total, preview)
+
+
+class GenerationRequest:
+    """
+    A generation with its images already encoded, so it can be sent to any
+    server in the pool
+    """
+
+    def __init__(
+        self,
+        config,
+        override,
+        prompt,
+        negative_prompt,
+        image,
+        mask,
+        hints,
+        lane=INTERACTIVE,
+    ):
+        self.config = config
+        self.lane = lane
+        self.override = override
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.image = image
+        self.mask = mask
+        self.hints: list[imageService_pb2.HintProto] = hints
+
+        builder = flatbuffers.Builder(0)
+        builder.Finish(config.Pack(builder))
+        self.config_fbs = bytes(builder.Output())
+
+    def for_batch_index(self, index) -> "GenerationRequest":
+        """
+        A copy of this request that only generates the image at index of the
+        batch count, with the seed the server would have used for it
+        """
+        config = copy.copy(self.config)
+        config.seed = derive_seed(self.config.seed, index)
+        config.batchCount = 1
+        return GenerationRequest(
+            config,
+            self.override,
+            self.prompt,
+            self.negative_prompt,
+            self.image,
+            self.mask,
+            self.hints,
+            self.lane,
+        )
+
+    @property
+    def models(self) -> tuple:
+        """
+        The models a server has to load for this request, used to send it
+        where they are already loaded
+        """
+        loras = tuple(sorted(lora.file for lora in self.config.loras or []))
+        return (self.config.model, self.config.refinerModel, loras)
+
+    async def to_proto(self, upload: ContentUpload | None = None):
+        image, mask, hints, contents = self.image, self.mask, self.hints, []
+
+        # send each unique tensor once in contents and refer to it by its digest
+        if upload is not None:
+            image = await upload.add(image)
+            mask = await upload.add(mask)
+            hints = []
+            for hp in self.hints:
+                digests = await asyncio.gather(
+                    *(upload.add(taw.tensor) for taw in hp.tensors)
+                )
+                hints.append(
+                    imageService_pb2.HintProto(
+                        hintType=hp.hintType,
+                        tensors=[
+                            imageService_pb2.TensorAndWeight(
+                                tensor=digest, weight=taw.weight
+                            )
+                            for taw, digest in zip(hp.tensors, digests)
+                        ],
+                    )
+                )
+            contents = list(upload.contents.values())
+
+        return imageService_pb2.ImageGenerationRequest(
+            image=image,
+            scaleFactor=1,
+            mask=mask,
+            hints=hints,
+            prompt=self.prompt,
+            negativePrompt=self.negative_prompt,
+            configuration=self.config_fbs,
+            override=self.override,
+            user="ComfyUI",
+            device="LAPTOP",
+            contents=contents,
+            chunked=True,
+        )
+
+
+async def prepare_request(inputs: dict, trace: Trace = NULL_TRACE) -> GenerationRequest:
     positive, negative = inputs.get("positive"), inputs.get("negative")
     image, mask = inputs.get("image"), inputs.get("mask")
-    version = inputs.get("version")
 
-    config = build_config(inputs)
-    override = build_override(inputs)
+    with trace.span("build config"):
+        config = build_config(inputs)
+        override = build_override(inputs)
 
     width = config.startWidth * 64
     height = config.startHeight * 64
 
-    builder = flatbuffers.Builder(0)
-    builder.Finish(config.Pack(builder))
-    config_fbs = bytes(builder.Output())
-
     # try:
     #     print("inputs")
     #     print(json.dumps(inputs, indent=4))
@@ -96,17 +383,23 @@ async def dt_sampler(inputs: dict):
     # except Exception as e:
     #     pass
 
-    contents = []
     img2img = None
     maskimg = None
     if image is not None:
-        img2img = convert_image_for_request(image, width=width, height=height)
+        with trace.span("encode image"):
+            img2img = await run_codec(
+                convert_image_for_request, image, width=width, height=height
+            )
     if mask is not None:
-        maskimg = convert_mask_for_request(mask, width=width, height=height)
+        with trace.span("encode mask"):
+            maskimg = await run_codec(
+                convert_mask_for_request, mask, width=width, height=height
+            )
 
     # hints can be with sampler, cnet, or lora
     # get hints from sampler
-    hints: HintStack = inputs.get("hints", [])
+    # copied, since the list belongs to the node that made it
+    hints: HintStack = list(inputs.get("hints") or [])
 
     # add hints from cnets
     cnets = inputs.get("control_net")
@@ -136,126 +429,418 @@ async def dt_sampler(inputs: dict):
             if hint_images is None:
                 continue
 
-            # hint images might be batched, so check for multiple images and add each
-            for i in range(hint_images.size(dim=0)):
-                if config.hiresFix:
-                    hint_tensor = convert_image_for_request(
-                        hint_images,
-                        hint_type,
-                        batch_index=i,
-                        width=config.hiresFixStartWidth * 64,
-                        height=config.hiresFixStartHeight * 64,
-                    )
-                    taw = imageService_pb2.TensorAndWeight()
-                    taw.weight = 1
-                    taw.tensor = hint_tensor
-                    taws.append(taw)
-
-                hint_tensor = convert_image_for_request(
+            # hint images might be batched, each image in the batch is added
+            hires_size = (
+                (config.hiresFixStartWidth * 64, config.hiresFixStartHeight * 64)
+                if config.hiresFix
+                else None
+            )
+            taws.append(
+                encode_hints(
                     hint_images,
                     hint_type,
-                    batch_index=i,
-                    width=width,
-                    height=height,
+                    hint_weight,
+                    width,
+                    height,
+                    hires_size,
+                    trace,
                 )
-                taw = imageService_pb2.TensorAndWeight()
-                taw.weight = hint_weight
-                taw.tensor = hint_tensor
-                taws.append(taw)
+            )
 
         if len(taws) > 0:
             hp = imageService_pb2.HintProto()
             hp.hintType = hint_type
-            hp.tensors.extend(taws)
+            for hint_taws in await asyncio.gather(*taws):
+                hp.tensors.extend(hint_taws)
             req_hints.append(hp)
 
-    progress = comfy.utils.ProgressBar(config.steps, inputs["unique_id"])
-
-    async with get_aio_channel(server, port, use_tls) as channel:
-        stub = imageService_pb2_grpc.ImageGenerationServiceStub(channel)
-        generate_stream = stub.GenerateImage(
-            imageService_pb2.ImageGenerationRequest(
-                image=img2img,
-                scaleFactor=1,
-                mask=maskimg,
-                hints=req_hints,
-                prompt=str(positive),
-                negativePrompt=str(negative),
-                configuration=config_fbs,
-                override=override,
-                user="ComfyUI",
-                device="LAPTOP",
-                contents=contents,
-            )
-        )
-
-        cancel_request.reset()
-        response_images = []
-        estimated_steps = (
-            config.steps * (1 + config.hiresFixStrength)
-            if config.hiresFix
-            else config.steps
+    if settings.compress_uploads:
+        compress_started = time.perf_counter()
+        threshold = settings.compress_uploads_threshold
+        if img2img is not None:
+            img2img = await run_codec(compress_tensor, img2img, threshold)
+        taws = [taw for hp in req_hints for taw in hp.tensors]
+        compressed = await asyncio.gather(
+            *(run_codec(compress_tensor, taw.tensor, threshold) for taw in taws)
         )
-        current_step = 0
-
-        while True:
-            response = await generate_stream.read()
-            if response == grpc.aio.EOF:
-                break
+        for taw, tensor in zip(taws, compressed):
+            taw.tensor = tensor
+        trace.add_span("compress uploads", compress_started, time.perf_counter())
+
+    return GenerationRequest(
+        config,
+        override,
+        str(positive),
+        str(negative),
+        img2img,
+        maskimg,
+        req_hints,
+        request_lane(inputs, config),
+    )
 
-            if cancel_request.should_cancel:
-                await channel.close()
-                raise Exception("canceled")
 
-            signpost = response.currentSignpost
-            if "sampling" in signpost:
-                current_step = signpost.sampling.step
-            elif "secondPassSampling" in signpost:
-                current_step = signpost.secondPassSampling.step + config.steps
+def request_lane(inputs: dict, config):
+    """
+    Small single images go in the interactive lane. Tiled diffusion, video,
+    and anything over settings.interactive_max_pixels in total is background
+    work
+    """
+    frames = (
+        inputs.get("num_frames", 1) if ModelVersion(inputs.get("version")).video else 1
+    )
+    pixels = (
+        config.startWidth
+        * config.startHeight
+        * 64
+        * 64
+        * config.batchCount
+        * config.batchSize
+        * frames
+    )
+    if config.tiledDiffusion or pixels > settings.interactive_max_pixels:
+        return BACKGROUND
+    return INTERACTIVE
+
+
+async def generate(
+    endpoint: Endpoint,
+    request: GenerationRequest,
+    progress,
+    version,
+    job: Job,
+    trace: Trace = NULL_TRACE,
+    retry_contents=True,
+) -> torch.Tensor:
+    """
+    Sends a prepared request to one endpoint and decodes the images it returns.
+    Runs on the channel pool's loop, see channel_pool.run
+    """
+    config = request.config
+    cancel_token = job.cancel_token
+    server, port, use_tls = endpoint.server, endpoint.port, endpoint.use_tls
+
+    sampling_started = False
+    request_metrics = RequestMetrics(endpoint)
+    track = f"job {job.id}"
+    upload = None
+    if settings.content_addressed:
+        upload = content_store.upload(server, port, use_tls)
+
+    try:
+        async with channel_pool.connect(server, port, use_tls) as channel:
+            stub = imageService_pb2_grpc.ImageGenerationServiceStub(channel)
+            send_started = time.perf_counter()
+            request_proto = await request.to_proto(upload)
+            request_size = request_proto.ByteSize()
+            job.bytes_sent += request_size
+            request_metrics.sent(request_size)
+            generate_stream = stub.GenerateImage(request_proto)
+            # cancels the call right away instead of at the next message
+            cancel_token.on_cancel(generate_stream.cancel)
+
+            try:
+                await generate_stream.wait_for_connection()
+            except (asyncio.CancelledError, grpc.aio.AioRpcError):
+                cancel_token.raise_if_canceled()
+                raise
+            request_metrics.connected()
+            trace.add_span(
+                "send request",
+                send_started,
+                time.perf_counter(),
+                track,
+                endpoint=str(endpoint),
+                bytes=request_size,
+            )
 
-            preview_image = response.previewImage
-            generated_images = response.generatedImages
+            expected_images = config.batchCount * config.batchSize
+            if ModelVersion(version).video and config.numFrames:
+                expected_images *= config.numFrames
+            response_images = ResponseImageBatch(expected_images, trace)
+            chunks = ChunkAssembler()
+            estimated_steps = (
+                config.steps * (1 + config.hiresFixStrength)
+                if config.hiresFix
+                else config.steps
+            )
+            current_step = 0
+            previews = PreviewStage(progress, version, estimated_steps, trace)
 
-            if current_step:
+            while True:
                 try:
-                    preview = None
-                    if preview_image and version and settings.show_preview:
-                        decoded_preview = decode_preview(preview_image, version)
-                        if decoded_preview is not None:
-                            preview = ("PNG", decoded_preview, MAX_PREVIEW_RESOLUTION)
-                    progress.update_absolute(
-                        current_step, total=estimated_steps, preview=preview
-                    )
-                except Exception as e:
-                    print("DrawThings-gRPC had an error decoding the preview image:", e)
+                    response = await generate_stream.read()
+                except (asyncio.CancelledError, grpc.aio.AioRpcError):
+                    cancel_token.raise_if_canceled()
+                    raise
+                if response == grpc.aio.EOF:
+                    if upload is not None:
+                        upload.complete()
+                    break
+
+                cancel_token.raise_if_canceled()
+
+                signpost = response.currentSignpost
+                if "sampling" in signpost:
+                    sampling_started = True
+                    current_step = signpost.sampling.step
+                elif "secondPassSampling" in signpost:
+                    current_step = signpost.secondPassSampling.step + config.steps
+
+                response_size = response.ByteSize()
+                phase = signpost.WhichOneof("signpost")
+                job.bytes_received += response_size
+                job.update(phase, current_step)
+                request_metrics.received(response_size, phase)
+                if phase is not None:
+                    trace.phase(track, phase, endpoint=str(endpoint))
+
+                if response.HasField("downloadSize"):
+                    chunks.expect(response.downloadSize)
+
+                preview_image = response.previewImage
+                generated_images = chunks.add(
+                    response.generatedImages,
+                    response.chunkState == imageService_pb2.ChunkState.MORE_CHUNKS,
+                )
+
+                if current_step:
+                    previews.update(current_step, preview_image)
+
+                if generated_images:
+                    previews.finish()
+                    await response_images.reserve(len(generated_images))
+                    for img_data in generated_images:
+                        await response_images.add(img_data)
+
+            if response_images.count == 0:
+                raise Exception("The Draw Things gRPC server returned no images")
+
+            trace.phase(track, None)
+            with trace.span("convert images", track):
+                images = await response_images.result()
+            request_metrics.finished()
+
+            if images is None:
+                raise Exception("There was an error converting the response image")
+
+            return images
+    except grpc.aio.AioRpcError as e:
+        request_metrics.failed(e.code())
+        content_store.forget(server, port, use_tls)
+        if e.code() == grpc.StatusCode.UNAVAILABLE:
+            model_catalog.invalidate(server, port, use_tls)
+        if not sampling_started and e.code() in ENDPOINT_FAILURE_CODES:
+            raise EndpointUnavailable(endpoint, e) from e
+
+        # the server may have lost contents it was sent before, e.g. after a
+        # restart. They were just forgotten, so this time every one is sent
+        if (
+            retry_contents
+            and upload is not None
+            and upload.omitted
+            and not sampling_started
+            and not cancel_token.should_cancel
+        ):
+            print(f"DrawThings-gRPC: {e.code()}, retrying with all contents")
+            return await generate(
+                endpoint, request, progress, version, job, trace, retry_contents=False
+            )
+        raise
+
+
+class PreviewStage:
+    """
+    Decodes preview images without holding up the response stream. While a
+    preview is decoding, newer ones only advance the progress bar
+    """
+
+    def __init__(self, progress, version, total, trace: Trace = NULL_TRACE):
+        self.progress = progress
+        self.version = version
+        self.total = total
+        self.trace = trace
+        self.step = 0
+        self.task: asyncio.Future | None = None
+
+    def update(self, step, preview_image):
+        self.step = step
+        decoding = self.task is not None and not self.task.done()
+
+        if preview_image and self.version and settings.show_preview and not decoding:
+            self.task = asyncio.ensure_future(self.decode(preview_image))
+        else:
+            self.progress.update_absolute(step, total=self.total, preview=None)
+
+    async def decode(self, preview_image):
+        try:
+            preview = None
+            with self.trace.span("decode preview", "previews", step=self.step):
+                decoded_preview = await run_codec(
+                    decode_preview, preview_image, self.version
+                )
+            if decoded_preview is not None:
+                preview = ("PNG", decoded_preview, MAX_PREVIEW_RESOLUTION)
+            self.progress.update_absolute(self.step, total=self.total, preview=preview)
+        except Exception as e:
+            print("DrawThings-gRPC had an error decoding the preview image:", e)
+
+    def finish(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.progress.update_absolute(self.total, total=self.total, preview=None)
+
+
+class ChunkAssembler:
+    """
+    Puts chunked generated images back together. The fragments are written
+    into one buffer, preallocated from downloadSize when the server sends it
+    """
+
+    def __init__(self):
+        self.buffer: bytearray | None = None
+        self.size = 0
+        self.expected_size = 0
+
+    def expect(self, download_size):
+        self.expected_size = download_size
+
+    def add(self, generated_images, more_chunks) -> list:
+        if not generated_images:
+            return []
+
+        # a whole image in a single message doesn't need to be copied
+        if self.buffer is None and not more_chunks:
+            return list(generated_images)
+
+        if self.buffer is None:
+            self.buffer = bytearray(self.expected_size)
+            self.size = 0
+
+        for chunk in generated_images:
+            end = self.size + len(chunk)
+            if end > len(self.buffer):
+                self.buffer.extend(bytes(end - len(self.buffer)))
+            self.buffer[self.size : end] = chunk
+            self.size = end
+
+        if more_chunks:
+            return []
+
+        image = self.buffer
+        if self.size < len(image):
+            image = memoryview(image)[: self.size]
+
+        self.buffer = None
+        self.expected_size = 0
+        return [image]
+
+
+class ResponseImageBatch:
+    """
+    Decodes response images while the stream is still open, each one straight
+    into its slot of a [B,H,W,C] batch. The batch is sized for the images the
+    request should return, and grows if more arrive than expected
+    """
+
+    def __init__(self, expected_count, trace: Trace = NULL_TRACE):
+        self.capacity = max(1, expected_count)
+        self.trace = trace
+        self.images: torch.Tensor | None = None
+        self.count = 0
+        self.decoding: list[asyncio.Future] = []
+
+    async def reserve(self, count):
+        """
+        Makes room for count more images, e.g. every frame of a video sent in
+        one message
+        """
+        needed = self.count + count
+        if self.images is None:
+            self.capacity = max(self.capacity, needed)
+        elif needed > len(self.images):
+            await self.grow(needed)
+
+    async def grow(self, capacity):
+        # pending decodes write into the current batch, so let them finish
+        # before it is copied
+        await asyncio.gather(*self.decoding)
+        grown = torch.empty((capacity, *self.images.shape[1:]), dtype=torch.float32)
+        grown[: self.count] = self.images
+        self.images = grown
+
+    async def add(self, response_image: bytes):
+        if self.images is None:
+            height, width, channels = read_image_shape(response_image)
+            self.images = torch.empty(
+                (self.capacity, height, width, channels), dtype=torch.float32
+            )
+        elif self.count == len(self.images):
+            await self.grow(len(self.images) * 2)
 
-            if generated_images:
-                progress.update_absolute(
-                    estimated_steps, total=estimated_steps, preview=None
+        self.decoding.append(
+            asyncio.ensure_future(
+                self.decode(response_image, self.images[self.count], self.count)
+            )
+        )
+        self.count += 1
+
+    async def decode(self, response_image, out, index):
+        with self.trace.span("decode image", "decoding", index=index):
+            return await run_codec(decode_response_image, response_image, out)
+
+    async def result(self) -> torch.Tensor | None:
+        decoded = await asyncio.gather(*self.decoding)
+        if not any(decoded):
+            return None
+
+        if not all(decoded):
+            return self.images[: self.count][torch.tensor(decoded)]
+        if self.count < len(self.images):
+            # a view would keep the unused slots of the batch alive
+            return self.images[: self.count].clone()
+        return self.images
+
+
+async def encode_hints(
+    hint_images,
+    hint_type,
+    weight,
+    width,
+    height,
+    hires_size,
+    trace: Trace = NULL_TRACE,
+):
+    """
+    Encodes every image in a hint batch, resizing the whole batch once per
+    resolution. With hires fix, each image is preceded by its hires fix
+    start size version
+    """
+    sizes = [(width, height)] if hires_size is None else [hires_size, (width, height)]
+    weights = [weight] if hires_size is None else [1, weight]
+
+    with trace.span(f"encode {hint_type} hint", "hints", images=len(hint_images)):
+        encoded = await asyncio.gather(
+            *(
+                run_codec(
+                    convert_images_for_request,
+                    hint_images,
+                    hint_type,
+                    width=w,
+                    height=h,
                 )
-                response_images.extend(generated_images)
-
-        if len(response_images) == 0:
-            raise Exception("The Draw Things gRPC server returned no images")
-
-        images = []
-        for img_data in response_images:
-            result = convert_response_image(img_data)
-            if result is not None:
-                data = result["data"]
-                width = result["width"]
-                height = result["height"]
-                channels = result["channels"]
-                mode = "RGBA" if channels == 4 else "RGB"
-                img = Image.frombytes(mode, (width, height), data)
-                image_np = np.array(img)
-                tensor_image = torch.from_numpy(image_np.astype(np.float32) / 255.0)
-                images.append(tensor_image)
-
-        if len(images) == 0:
-            raise Exception("There was an error converting the response image")
-
-        return (torch.stack(images),)
+                for w, h in sizes
+            )
+        )
+
+    taws = []
+    for tensors in zip(*encoded):
+        for tensor, taw_weight in zip(tensors, weights):
+            taw = imageService_pb2.TensorAndWeight()
+            taw.weight = taw_weight
+            taw.tensor = tensor
+            taws.append(taw)
+
+    return taws
 
 
 def build_override(inputs):
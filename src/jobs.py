@@ -0,0 +1,136 @@
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from .util import CancelToken
+
+_job_ids = itertools.count(1)
+
+
+class Job:
+    """
+    One generation request, from waiting for a server until its images are
+    decoded. A sampler can have several, when a batch is fanned out or tiled
+    """
+
+    def __init__(self, unique_id, model, width, height, lane, cancel_token):
+        self.id = next(_job_ids)
+        self.unique_id = unique_id
+        self.model = model
+        self.width = width
+        self.height = height
+        self.lane = lane
+        self.cancel_token = cancel_token
+        self.state = "queued"
+        self.endpoint = None
+        self.signpost = None
+        self.step = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.updated_at = self.submitted_at
+        self._rate_start = None
+
+    def start(self, endpoint):
+        self.state = "running"
+        self.endpoint = str(endpoint)
+        self.started_at = self.updated_at = time.monotonic()
+
+    def requeue(self):
+        self.state = "queued"
+        self.endpoint = None
+        self._rate_start = None
+
+    def update(self, signpost, step):
+        now = time.monotonic()
+        self.updated_at = now
+        if signpost is not None:
+            self.signpost = signpost
+        if step and self._rate_start is None:
+            self._rate_start = (now, step)
+        self.step = step
+
+    @property
+    def step_rate(self):
+        """
+        Steps per second since sampling started
+        """
+        if self._rate_start is None:
+            return None
+        started, first_step = self._rate_start
+        elapsed = self.updated_at - started
+        return (self.step - first_step) / elapsed if elapsed > 0 else None
+
+    def to_dict(self):
+        now = time.monotonic()
+        return {
+            "id": self.id,
+            "unique_id": self.unique_id,
+            "state": self.state,
+            "lane": self.lane,
+            "endpoint": self.endpoint,
+            "model": self.model,
+            "resolution": [self.width, self.height],
+            "signpost": self.signpost,
+            "step": self.step,
+            "step_rate": self.step_rate,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "age": now - self.submitted_at,
+            # seconds since the server last sent anything, to spot stuck streams
+            "idle": now - self.updated_at,
+            "canceled": self.cancel_token.should_cancel,
+        }
+
+
+class JobRegistry:
+    """
+    Keeps every generation that is queued or in flight, for /dt_grpc/jobs
+    """
+
+    def __init__(self):
+        self._jobs: dict[int, Job] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def track(self, request, cancel_token: CancelToken):
+        """
+        Records a job for a GenerationRequest while the context is open. The
+        job has its own cancel token, which is also cancelled with the
+        sampler's
+        """
+        job_token = CancelToken(cancel_token.key)
+        cancel_token.on_cancel(job_token.cancel)
+        job = Job(
+            cancel_token.key,
+            request.config.model,
+            request.config.startWidth * 64,
+            request.config.startHeight * 64,
+            request.lane,
+            job_token,
+        )
+        with self._lock:
+            self._jobs[job.id] = job
+        try:
+            yield job
+        finally:
+            with self._lock:
+                self._jobs.pop(job.id, None)
+
+    def list(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [job.to_dict() for job in jobs]
+
+    def cancel(self, job_id) -> bool:
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return False
+        job.cancel_token.cancel()
+        return True
+
+
+jobs = JobRegistry()
@@ -0,0 +1,207 @@
+import bisect
+import functools
+import threading
+import time
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+BYTES_BUCKETS = tuple(1024 * 4**n for n in range(11))
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+_metrics = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=SECONDS_BUCKETS, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+        # per label set: count in each bucket (not cumulative), then the sum
+        self._values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                labels = _format_labels(self.labels, key, [("le", bound)])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {counts[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render_metrics() -> str:
+    """
+    All metrics in the Prometheus text format
+    """
+    return "\n".join(line for metric in _metrics for line in metric.render()) + "\n"
+
+
+def cpu_timed(histogram: Histogram, **labels):
+    """
+    Records the CPU time of each call in histogram. Uses the calling thread's
+    CPU time, so it is accurate for functions run on the codec executor
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.thread_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.thread_time() - started, **labels)
+
+        return wrapper
+
+    return decorator
+
+
+requests_total = Counter(
+    "dt_grpc_requests_total", "Generation requests sent", ["endpoint"]
+)
+errors_total = Counter(
+    "dt_grpc_errors_total", "Generation requests that failed", ["endpoint", "code"]
+)
+connect_seconds = Histogram(
+    "dt_grpc_connect_seconds",
+    "Time for a generation call to connect",
+    labels=["endpoint"],
+)
+first_signpost_seconds = Histogram(
+    "dt_grpc_first_signpost_seconds",
+    "Time from sending a request to the first signpost",
+    labels=["endpoint"],
+)
+phase_seconds = Histogram(
+    "dt_grpc_phase_seconds",
+    "Time spent in each phase reported by the server's signposts",
+    labels=["endpoint", "phase"],
+)
+request_bytes_sent = Histogram(
+    "dt_grpc_request_bytes_sent",
+    "Bytes sent per generation request",
+    BYTES_BUCKETS,
+    ["endpoint"],
+)
+request_bytes_received = Histogram(
+    "dt_grpc_request_bytes_received",
+    "Bytes received per generation request",
+    BYTES_BUCKETS,
+    ["endpoint"],
+)
+codec_cpu_seconds = Histogram(
+    "dt_grpc_codec_cpu_seconds",
+    "CPU time spent encoding and decoding images",
+    labels=["operation"],
+)
+fpzip_ratio = Histogram(
+    "dt_grpc_fpzip_ratio",
+    "Compressed size over raw size of fpzip tensors",
+    RATIO_BUCKETS,
+    ["direction"],
+)
+
+
+class RequestMetrics:
+    """
+    Times one generation request: how long the call takes to connect and to
+    report its first signpost, and how long each signposted phase lasts
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = str(endpoint)
+        self.sent_at = None
+        self.phase = None
+        self.phase_started = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def sent(self, size):
+        requests_total.inc(endpoint=self.endpoint)
+        self.sent_at = time.perf_counter()
+        self.bytes_sent = size
+
+    def connected(self):
+        connect_seconds.observe(
+            time.perf_counter() - self.sent_at, endpoint=self.endpoint
+        )
+
+    def received(self, size, signpost):
+        self.bytes_received += size
+        if signpost is None or signpost == self.phase:
+            return
+
+        now = time.perf_counter()
+        if self.phase is None:
+            first_signpost_seconds.observe(now - self.sent_at, endpoint=self.endpoint)
+        else:
+            self._end_phase(now)
+        self.phase, self.phase_started = signpost, now
+
+    def _end_phase(self, now):
+        if self.phase is not None:
+            phase_seconds.observe(
+                now - self.phase_started, endpoint=self.endpoint, phase=self.phase
+            )
+            self.phase = None
+
+    def finished(self):
+        self._end_phase(time.perf_counter())
+        request_bytes_sent.observe(self.bytes_sent, endpoint=self.endpoint)
+        request_bytes_received.observe(self.bytes_received, endpoint=self.endpoint)
+
+    def failed(self, code):
+        errors_total.inc(endpoint=self.endpoint, code=code.name)
+        self.finished()
@@ -0,0 +1,141 @@
+import asyncio
+import base64
+import json
+import time
+
+from google.protobuf.json_format import MessageToJson
+
+from .channel_pool import channel_pool
+from .data_types import ModelsInfo, UpscalerInfo
+from .generated import imageService_pb2, imageService_pb2_grpc
+
+CATALOG_TTL = 30
+
+official_upscalers = [
+    "realesrgan_x2plus_f16.ckpt",
+    "realesrgan_x4plus_f16.ckpt",
+    "realesrgan_x4plus_anime_6b_f16.ckpt",
+    "esrgan_4x_universal_upscaler_v2_sharp_f16.ckpt",
+    "remacri_4x_f16.ckpt",
+    "4x_ultrasharp_f16.ckpt",
+]
+
+
+async def fetch_models_info(server, port, use_tls) -> tuple[ModelsInfo, int]:
+    async with channel_pool.connect(server, port, use_tls) as channel:
+        stub = imageService_pb2_grpc.ImageGenerationServiceStub(channel)
+        response = await stub.Echo(imageService_pb2.EchoRequest(name="ComfyUI"))
+        response_json = json.loads(MessageToJson(response))
+        override = dict(response_json["override"])
+        model_info = {
+            k: json.loads(str(base64.b64decode(override[k]), "utf8"))
+            for k in override.keys()
+        }
+
+        if "upscalers" not in model_info:
+            model_info["upscalers"] = [
+                UpscalerInfo(file=f, name=f) for f in official_upscalers
+            ]
+
+        models_info = ModelsInfo(
+            models=model_info["models"],
+            controlNets=model_info["controlNets"],
+            loras=model_info["loras"],
+            upscalers=model_info["upscalers"],
+            textualInversions=model_info["textualInversions"],
+        )
+        return models_info, response.serverIdentifier
+
+
+async def echo_server_identifier(server, port, use_tls, timeout=None) -> int:
+    """
+    Echoes the server without parsing its models, for health checks
+    """
+    async with channel_pool.connect(server, port, use_tls) as channel:
+        stub = imageService_pb2_grpc.ImageGenerationServiceStub(channel)
+        response = await stub.Echo(
+            imageService_pb2.EchoRequest(name="ComfyUI"), timeout=timeout
+        )
+        return response.serverIdentifier
+
+
+class CatalogEntry:
+    def __init__(self, models_info: ModelsInfo, server_identifier: int):
+        self.models_info = models_info
+        self.server_identifier = server_identifier
+        self.fetched_at = time.monotonic()
+
+    @property
+    def age(self):
+        return time.monotonic() - self.fetched_at
+
+
+class ModelCatalog:
+    """
+    Caches the models list each server reports through Echo. Entries older
+    than the ttl are still returned while a refresh runs in the background
+    """
+
+    def __init__(self, ttl=CATALOG_TTL):
+        self.ttl = ttl
+        self._entries: dict[tuple, CatalogEntry] = {}
+        self._refreshing: dict[tuple, asyncio.Task] = {}
+
+    @staticmethod
+    def _key(server, port, use_tls):
+        return (server, str(port), bool(use_tls))
+
+    async def get(self, server, port, use_tls, refresh=False) -> ModelsInfo:
+        key = self._key(server, port, use_tls)
+        entry = self._entries.get(key)
+
+        if entry is None or refresh:
+            return await self.refresh(server, port, use_tls)
+
+        if entry.age > self.ttl and key not in self._refreshing:
+            task = asyncio.ensure_future(self.refresh(server, port, use_tls))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._refreshing[key] = task
+
+        return entry.models_info
+
+    async def refresh(self, server, port, use_tls) -> ModelsInfo:
+        key = self._key(server, port, use_tls)
+        try:
+            models_info, server_identifier = await channel_pool.run(
+                fetch_models_info(server, port, use_tls)
+            )
+        except Exception:
+            self._entries.pop(key, None)
+            raise
+        finally:
+            self._refreshing.pop(key, None)
+
+        self._entries[key] = CatalogEntry(models_info, server_identifier)
+        return models_info
+
+    def server_identifier(self, server, port, use_tls) -> int | None:
+        entry = self._entries.get(self._key(server, port, use_tls))
+        return entry.server_identifier if entry is not None else None
+
+    def invalidate(self, server=None, port=None, use_tls=None, server_identifier=None):
+        """
+        Drops cached entries matching every argument given. With no arguments,
+        the whole catalog is cleared
+        """
+        for key, entry in list(self._entries.items()):
+            if server is not None and key[0] != server:
+                continue
+            if port is not None and key[1] != str(port):
+                continue
+            if use_tls is not None and key[2] != bool(use_tls):
+                continue
+            if (
+                server_identifier is not None
+                and entry.server_identifier != server_identifier
+            ):
+                continue
+            del self._entries[key]
+
+
+model_catalog = ModelCatalog()
@@ -7,7 +7,7 @@ import sys
 import grpc
 from torchvision.transforms import v2
 
-from .. import cancel_request
+from .. import cancel_requests
 from .data_types import *
 from .draw_things import dt_sampler, get_files
 
@@ -26,7 +26,7 @@ class DrawThingsSampler:
             # fmt: off
             "required": {
                 "settings": (["Basic", "Advanced", "All"], { "default": "Basic" }),
-                "server": ("STRING", { "multiline": False, "default": DrawThingsLists.dtserver, "tooltip": "The IP address of the Draw Things gRPC Server." },),
+                "server": ("STRING", { "multiline": False, "default": DrawThingsLists.dtserver, "tooltip": "The IP address of the Draw Things gRPC Server. Separate several servers with commas to share generations between them." },),
                 "port": ("STRING", { "multiline": False, "default": DrawThingsLists.dtport, "tooltip": "The port that the Draw Things gRPC Server is listening on." },),
                 "use_tls": ("BOOLEAN", { "default": True }),
                 "model": ("DT_MODEL", { "model_type": "models", "tooltip": "The model used for denoising the input latent." },),
@@ -129,40 +129,40 @@ class DrawThingsSampler:
     CATEGORY = "DrawThings"
 
     async def sample(self, **kwargs):
-        try:
-            await get_files(kwargs["server"], kwargs["port"], kwargs["use_tls"])
-        except Exception:
-            raise Exception(
-                "Couldn't connect to Draw Things gRPC server. Check your server and settings, and try again."
-            )
-
         DrawThingsSampler.last_gen_canceled = False
         model_input = kwargs.get("model")
-        if type(model_input) is not dict:
-            raise Exception("Please select a model")
-        model = model_input.get("value")
-        if model is None or model.get("file") is None:
+        model = model_input.get("value") if type(model_input) is dict else None
+        if type(model) is not dict or model.get("file") is None:
+            # the model widget reads "Not connected" when the server is down,
+            # which deserves the connection error rather than asking for a model
+            try:
+                await get_files(kwargs["server"], kwargs["port"], kwargs["use_tls"])
+            except Exception:
+                raise Exception(
+                    "Couldn't connect to Draw Things gRPC server. Check your server and settings, and try again."
+                )
             raise Exception("Please select a model")
 
         kwargs["model"] = model.get("file")
         kwargs["version"] = model.get("version")
         kwargs["model_info"] = model
 
-        try:
-            result = await dt_sampler(kwargs)
-            if result is None:
-                raise Exception("Failed to generate image")
-            return result
-        except grpc.aio.AioRpcError as e:
-            if e.code() == grpc.StatusCode.UNAVAILABLE:
-                raise Exception(
-                    "Could not connect to Draw Things gRPC server. Please check the server address and port."
-                )
-            raise e
-        except Exception as e:
-            if cancel_request.should_cancel:
-                DrawThingsSampler.last_gen_canceled = True
-            raise e
+        with cancel_requests.scope(kwargs.get("unique_id")) as cancel_token:
+            try:
+                result = await dt_sampler(kwargs, cancel_token)
+                if result is None:
+                    raise Exception("Failed to generate image")
+                return result
+            except grpc.aio.AioRpcError as e:
+                if e.code() == grpc.StatusCode.UNAVAILABLE:
+                    raise Exception(
+                        "Couldn't connect to Draw Things gRPC server. Check your server and settings, and try again."
+                    )
+                raise e
+            except Exception as e:
+                if cancel_token.should_cancel:
+                    DrawThingsSampler.last_gen_canceled = True
+                raise e
 
     @classmethod
     async def VALIDATE_INPUTS(cls, width, height, tiled_diffusion):
@@ -6,13 +6,25 @@ from aiohttp.web_request import Request
 from google.protobuf.json_format import MessageToJson
 from server import PromptServer  # type: ignore
 
-from .. import cancel_request, settings
+from .. import cancel_requests, settings
+from .channel_pool import channel_pool
 from .draw_things import get_files
 from .generated import imageService_pb2, imageService_pb2_grpc
+from .jobs import jobs
+from .metrics import render_metrics
+from .server_pool import server_pools_status
+from .tracing import tracer
 
 routes = PromptServer.instance.routes
 
 
+async def close_channels(app):
+    await channel_pool.close()
+
+
+PromptServer.instance.app.on_shutdown.append(close_channels)
+
+
 @routes.post("/dt_grpc/files_info")
 async def handle_files_info_request(request):
     """
@@ -23,12 +35,13 @@ async def handle_files_info_request(request):
         server = post.get("server")
         port = post.get("port")
         use_tls = True if post.get("use_tls") == "true" else False
+        refresh = True if post.get("refresh") == "true" else False
 
         if server is None or port is None:
             return web.json_response(
                 {"error": "Missing server or port parameter"}, status=400
             )
-        all_files = await get_files(server, port, use_tls)
+        all_files = await get_files(server, port, use_tls, refresh)
         return web.json_response(all_files)
     except Exception as e:
         print(e)
@@ -127,10 +140,74 @@ async def handle_preview_request(request):
 @routes.post("/dt_grpc/interrupt")
 async def handle_interrupt_request(request):
     """
-    Handles interrupt requests to the gRPC server by setting the cancel request flag.
+    Cancels the gRPC request of the sampler with the posted unique_id, or of
+    every sampler if there is no unique_id.
+    """
+    try:
+        post = await request.post()
+        unique_id = post.get("unique_id")
+    except Exception:
+        unique_id = None
+    canceled = cancel_requests.cancel(unique_id)
+    return web.json_response({"canceled": canceled})
+
+
+@routes.get("/dt_grpc/jobs")
+async def handle_jobs_request(request):
+    """
+    Lists the generations that are queued or in flight, and the servers they
+    are spread over.
+    """
+    return web.json_response({"jobs": jobs.list(), "servers": server_pools_status()})
+
+
+@routes.post("/dt_grpc/jobs/{job_id}/cancel")
+async def handle_job_cancel_request(request):
+    """
+    Cancels one queued or in flight generation.
+    """
+    try:
+        job_id = int(request.match_info["job_id"])
+    except ValueError:
+        return web.json_response({"error": "Invalid job id"}, status=400)
+
+    if not jobs.cancel(job_id):
+        return web.json_response({"error": "No such job"}, status=404)
+    return web.json_response({"canceled": job_id})
+
+
+@routes.get("/dt_grpc/metrics")
+async def handle_metrics_request(request):
+    """
+    Returns the gRPC client's metrics in the Prometheus text format.
+    """
+    return web.Response(
+        text=render_metrics(), content_type="text/plain", charset="utf-8"
+    )
+
+
+@routes.get("/dt_grpc/traces")
+async def handle_traces_request(request):
     """
-    cancel_request.cancel()
-    return web.json_response()
+    Lists the traces in the ring buffer, most recent last. Tracing is enabled
+    with DT_GRPC_TRACE or DT_GRPC_TRACE_DIR.
+    """
+    return web.json_response({"enabled": tracer.enabled, "traces": tracer.list()})
+
+
+@routes.get("/dt_grpc/traces/{trace_id}")
+async def handle_trace_request(request):
+    """
+    Returns one trace as Chrome trace JSON, for chrome://tracing or Perfetto.
+    """
+    try:
+        trace = tracer.get(int(request.match_info["trace_id"]))
+    except ValueError:
+        trace = None
+
+    if trace is None:
+        return web.json_response({"error": "No such trace"}, status=404)
+    return web.json_response(trace.to_chrome())
 
 
 @routes.get("/dt_grpc/logo.svg")
@@ -0,0 +1,124 @@
+import asyncio
+import threading
+import time
+
+from .. import settings
+from .util import CancelToken
+
+# how many later jobs can be dispatched ahead of a job before it goes next
+MAX_SKIPS = 8
+
+# quick generations someone is waiting on, and everything else
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+
+class PendingJob:
+    """
+    A generation waiting for an endpoint. Created on the event loop of the
+    sampler it belongs to, which is woken through that loop once the job is
+    dispatched
+    """
+
+    def __init__(self, models=None, exclude=(), lane=INTERACTIVE):
+        self.models = models
+        self.exclude = exclude
+        self.lane = lane
+        self.submitted_at = time.monotonic()
+        self.skipped = 0
+        self.endpoint = None
+        self.ready = asyncio.get_running_loop().create_future()
+
+    def assign(self, endpoint):
+        self.endpoint = endpoint
+        loop = self.ready.get_loop()
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(self.wake)
+
+    def wake(self):
+        if not self.ready.done():
+            self.ready.set_result(None)
+
+    async def wait(self, cancel_token: CancelToken | None = None):
+        if cancel_token is not None:
+            cancel_token.on_cancel(self.wake)
+        if self.endpoint is None:
+            await self.ready
+        if cancel_token is not None:
+            cancel_token.raise_if_canceled()
+
+
+class JobScheduler:
+    """
+    Orders the generations waiting for a server pool. Each time an endpoint
+    has room, interactive jobs go before background ones. Within a lane, the
+    next job is the oldest one using the models that endpoint already has
+    loaded, so jobs for the same model run back to back instead of making
+    the server swap checkpoints. A job that has been passed over MAX_SKIPS
+    times goes next regardless
+    """
+
+    def __init__(self, max_skips=MAX_SKIPS):
+        self.max_skips = max_skips
+        self.pending: list[PendingJob] = []
+        self.lock = threading.Lock()
+
+    def submit(self, job: PendingJob):
+        with self.lock:
+            # interactive jobs are always let in, background ones only while
+            # the queue has room
+            if job.lane == BACKGROUND:
+                queued = sum(1 for j in self.pending if j.lane == BACKGROUND)
+                if queued >= settings.max_queued_jobs:
+                    raise Exception(
+                        f"Too many generations are waiting for a Draw Things server ({queued})"
+                    )
+            self.pending.append(job)
+
+    def withdraw(self, job: PendingJob):
+        with self.lock:
+            if job in self.pending:
+                self.pending.remove(job)
+
+    def next(self, free_for):
+        """
+        Takes the next job that can run now, with the endpoints free for it.
+        free_for(job) returns those endpoints
+        """
+        ready = [(job, free_for(job)) for job in self.pending]
+        ready = [(job, free) for job, free in ready if len(free) > 0]
+        if len(ready) == 0:
+            return None
+
+        def warmth(entry):
+            job, free = entry
+            return max(endpoint.warmth(job.models) for endpoint in free)
+
+        starved = [entry for entry in ready if entry[0].skipped >= self.max_skips]
+        interactive = [entry for entry in ready if entry[0].lane == INTERACTIVE]
+        if len(starved) > 0:
+            choice = starved[0]
+        else:
+            lane = interactive if len(interactive) > 0 else ready
+            warmest = max(warmth(entry) for entry in lane)
+            choice = next(entry for entry in lane if warmth(entry) == warmest)
+
+        for job, _ in ready:
+            if job is choice[0]:
+                break
+            job.skipped += 1
+
+        self.pending.remove(choice[0])
+        return choice
+
+    def status(self):
+        now = time.monotonic()
+        return [
+            {
+                "model": job.models[0] if job.models else None,
+                "lane": job.lane,
+                "waiting": now - job.submitted_at,
+                "skipped": job.skipped,
+            }
+            for job in self.pending
+        ]
@@ -0,0 +1,362 @@
+import asyncio
+import concurrent.futures
+import time
+from contextlib import asynccontextmanager
+
+import grpc
+
+from .. import settings
+from .channel_pool import channel_pool
+from .model_catalog import echo_server_identifier, model_catalog
+from .scheduler import BACKGROUND, INTERACTIVE, JobScheduler, PendingJob
+from .util import CancelToken
+
+# how often endpoints are checked with Echo
+HEALTH_CHECK_INTERVAL = 10
+# how long a health check waits for Echo before counting it as a failure
+HEALTH_CHECK_TIMEOUT = 2
+# consecutive failures before an endpoint's circuit breaker opens
+FAILURE_THRESHOLD = 3
+# how long an open breaker keeps an endpoint out before it is probed again
+BREAKER_TIMEOUT = 30
+# weight of the newest sample in the Echo latency average
+LATENCY_SMOOTHING = 0.3
+
+# errors that mean the endpoint itself is in trouble, rather than the request
+ENDPOINT_FAILURE_CODES = (
+    grpc.StatusCode.UNAVAILABLE,
+    grpc.StatusCode.DEADLINE_EXCEEDED,
+    grpc.StatusCode.RESOURCE_EXHAUSTED,
+)
+
+
+class EndpointUnavailable(Exception):
+    """
+    Raised when a generation fails on an endpoint before sampling started, so
+    it can be sent to another endpoint instead
+    """
+
+    def __init__(self, endpoint, error: grpc.aio.AioRpcError):
+        super().__init__(f"{endpoint} is unavailable: {error.code()}")
+        self.endpoint = endpoint
+        self.error = error
+
+
+class Endpoint:
+    def __init__(self, server, port, use_tls, weight=1.0):
+        self.server = server
+        self.port = str(port)
+        self.use_tls = bool(use_tls)
+        self.weight = weight
+        self.in_flight = 0
+        # how many of the generations in flight are from the background lane
+        self.background_in_flight = 0
+        # the model, refiner and loras of the last generation sent here
+        self.models: tuple | None = None
+        # average Echo round trip in seconds
+        self.latency: float | None = None
+        self.failures = 0
+        self.opened_at: float | None = None
+
+    @property
+    def key(self):
+        return (self.server, self.port, self.use_tls)
+
+    @property
+    def load(self):
+        return (self.in_flight + 1) / self.weight
+
+    @property
+    def state(self):
+        """
+        closed: taking generations. open: left out after repeated failures.
+        half_open: has been out long enough that the next health check decides
+        """
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < BREAKER_TIMEOUT:
+            return "open"
+        return "half_open"
+
+    @property
+    def usable(self):
+        return self.state == "closed"
+
+    def record_success(self, latency: float | None = None):
+        self.failures = 0
+        self.opened_at = None
+        if latency is not None:
+            self.latency = (
+                latency
+                if self.latency is None
+                else LATENCY_SMOOTHING * latency
+                + (1 - LATENCY_SMOOTHING) * self.latency
+            )
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= FAILURE_THRESHOLD:
+            self.opened_at = time.monotonic()
+
+    def warmth(self, models) -> int:
+        """
+        2 if the endpoint last ran exactly these models, 1 if only the main
+        model matches, otherwise 0
+        """
+        if models is None or self.models is None:
+            return 0
+        if self.models == models:
+            return 2
+        return 1 if self.models[0] == models[0] else 0
+
+    def __repr__(self):
+        return f"{self.server}:{self.port}"
+
+
+def parse_endpoints(server: str, port, use_tls) -> list[Endpoint]:
+    """
+    Parses a server field listing one or more endpoints separated by commas.
+    Each is host[:port][*weight], and the port field is used when an endpoint
+    doesn't give its own. e.g. "mac-studio*2, mac-mini:7860"
+    """
+    endpoints = []
+    for spec in str(server).split(","):
+        spec = spec.strip()
+        if not spec:
+            continue
+
+        weight = 1.0
+        if "*" in spec:
+            spec, weight_spec = spec.rsplit("*", 1)
+            try:
+                weight = max(float(weight_spec), 0.01)
+            except ValueError:
+                weight = 1.0
+
+        host, endpoint_port = spec, port
+        if spec.count(":") == 1:
+            host, endpoint_port = spec.split(":")
+
+        endpoints.append(Endpoint(host.strip(), endpoint_port, use_tls, weight))
+
+    if len(endpoints) == 0:
+        endpoints.append(Endpoint(str(server).strip(), port, use_tls))
+
+    return endpoints
+
+
+class ServerPool:
+    """
+    Spreads generations over several Draw Things servers. Each request goes to
+    the endpoint with the fewest requests in flight relative to its weight.
+    Endpoints are checked with Echo in the background, and ones that keep
+    failing are left out until a check succeeds again. Generations waiting
+    for a free endpoint are ordered by the JobScheduler
+    """
+
+    def __init__(self, endpoints: list[Endpoint]):
+        self.endpoints = endpoints
+        self.checked_at = None
+        self._checking: concurrent.futures.Future | None = None
+        self.scheduler = JobScheduler()
+        self._next = 0
+
+    def candidates(self, exclude=()) -> list[Endpoint]:
+        remaining = [endpoint for endpoint in self.endpoints if endpoint not in exclude]
+        usable = [endpoint for endpoint in remaining if endpoint.usable]
+        # with every breaker open it's still worth trying rather than failing
+        return usable if len(usable) > 0 else remaining
+
+    async def check_health(self):
+        async def check_endpoint(endpoint: Endpoint):
+            if endpoint.state == "open":
+                return
+            started = time.monotonic()
+            try:
+                server_identifier = await channel_pool.run(
+                    echo_server_identifier(
+                        endpoint.server,
+                        endpoint.port,
+                        endpoint.use_tls,
+                        timeout=HEALTH_CHECK_TIMEOUT,
+                    )
+                )
+                endpoint.record_success(time.monotonic() - started)
+            except Exception:
+                endpoint.record_failure()
+                return
+
+            # a different identifier means the server restarted, and its
+            # models may have changed
+            cached = model_catalog.server_identifier(*endpoint.key)
+            if cached is not None and cached != server_identifier:
+                model_catalog.invalidate(*endpoint.key)
+
+        self.checked_at = time.monotonic()
+        await asyncio.gather(*(check_endpoint(e) for e in self.endpoints))
+
+    def ensure_checked(self):
+        # a single server is always tried, so there's nothing to check
+        if len(self.endpoints) < 2:
+            return
+
+        # checks run in the background on the channel loop, which outlives
+        # the sampler's loop. Endpoints not checked yet count as usable
+        due = (
+            self.checked_at is None
+            or time.monotonic() - self.checked_at > HEALTH_CHECK_INTERVAL
+        )
+        if due and (self._checking is None or self._checking.done()):
+            self._checking = asyncio.run_coroutine_threadsafe(
+                self.check_health(), channel_pool.loop
+            )
+
+    def pick(self, candidates: list[Endpoint], models=None) -> Endpoint:
+        # loading a model takes far longer than most generations, so an idle
+        # endpoint that already has it loaded wins over load balancing
+        idle = [endpoint for endpoint in candidates if endpoint.in_flight == 0]
+        warmest = max((endpoint.warmth(models) for endpoint in idle), default=0)
+        if warmest > 0:
+            candidates = [e for e in idle if e.warmth(models) == warmest]
+
+        # rotate the starting point so ties don't always go to the first endpoint
+        self._next = (self._next + 1) % len(candidates)
+        rotated = candidates[self._next :] + candidates[: self._next]
+        return min(rotated, key=lambda e: (e.load, e.latency or 0))
+
+    def free_for(self, job: PendingJob) -> list[Endpoint]:
+        return [
+            endpoint
+            for endpoint in self.candidates(job.exclude)
+            if self.has_slot(endpoint, job.lane)
+        ]
+
+    @staticmethod
+    def has_slot(endpoint: Endpoint, lane):
+        concurrency = settings.server_concurrency
+        if endpoint.in_flight < concurrency:
+            return True
+        # the interactive slots are only for getting past background work,
+        # so they open up once background jobs hold every normal slot
+        return (
+            lane == INTERACTIVE
+            and endpoint.background_in_flight >= concurrency
+            and endpoint.in_flight < concurrency + settings.interactive_slots
+        )
+
+    def dispatch(self):
+        """
+        Hands free endpoints to waiting jobs, in the order the scheduler picks
+        """
+        with self.scheduler.lock:
+            while True:
+                choice = self.scheduler.next(self.free_for)
+                if choice is None:
+                    return
+                job, free = choice
+                endpoint = self.pick(free, models=job.models)
+                endpoint.in_flight += 1
+                if job.lane == BACKGROUND:
+                    endpoint.background_in_flight += 1
+                if job.models is not None:
+                    endpoint.models = job.models
+                job.assign(endpoint)
+
+    def release(self, endpoint: Endpoint, lane):
+        endpoint.in_flight -= 1
+        if lane == BACKGROUND:
+            endpoint.background_in_flight -= 1
+        self.dispatch()
+
+    @asynccontextmanager
+    async def acquire(
+        self,
+        models=None,
+        exclude=(),
+        cancel_token: CancelToken | None = None,
+        lane=INTERACTIVE,
+    ):
+        """
+        Submits a generation to the scheduler and waits for an endpoint, which
+        is counted as in flight until the context exits. Endpoints run at most
+        settings.server_concurrency generations at once, plus
+        settings.interactive_slots for the interactive lane while background
+        work fills the others. models is the
+        (model, refiner, loras) the generation uses, see
+        GenerationRequest.models. Endpoints in exclude are not picked, see
+        has_fallback
+        """
+        self.ensure_checked()
+
+        job = PendingJob(models, exclude, lane)
+        self.scheduler.submit(job)
+        self.dispatch()
+        try:
+            await job.wait(cancel_token)
+        except BaseException:
+            self.scheduler.withdraw(job)
+            if job.endpoint is not None:
+                self.release(job.endpoint, lane)
+            raise
+
+        endpoint = job.endpoint
+        try:
+            yield endpoint
+        except EndpointUnavailable:
+            endpoint.models = None
+            endpoint.record_failure()
+            raise
+        except grpc.aio.AioRpcError as e:
+            if e.code() in ENDPOINT_FAILURE_CODES:
+                endpoint.record_failure()
+            raise
+        else:
+            endpoint.record_success()
+        finally:
+            self.release(endpoint, lane)
+
+    def has_fallback(self, exclude) -> bool:
+        return len(self.candidates(exclude)) > 0
+
+    def status(self):
+        return {
+            "endpoints": self.endpoint_status(),
+            "queued": self.scheduler.status(),
+        }
+
+    def endpoint_status(self):
+        return [
+            {
+                "server": endpoint.server,
+                "port": endpoint.port,
+                "use_tls": endpoint.use_tls,
+                "weight": endpoint.weight,
+                "in_flight": endpoint.in_flight,
+                "background_in_flight": endpoint.background_in_flight,
+                "state": endpoint.state,
+                "latency": endpoint.latency,
+                "model": endpoint.models[0] if endpoint.models else None,
+            }
+            for endpoint in self.endpoints
+        ]
+
+
+_pools: dict[tuple, ServerPool] = {}
+
+
+def get_server_pool(server, port, use_tls) -> ServerPool:
+    """
+    Returns the pool for a server field, the same one each time so in flight
+    counts are shared by every sampler using it
+    """
+    key = (str(server), str(port), bool(use_tls))
+    if key not in _pools:
+        _pools[key] = ServerPool(parse_endpoints(server, port, use_tls))
+    return _pools[key]
+
+
+def server_pools_status():
+    return [
+        {"server": key[0], "port": key[1], "use_tls": key[2], **pool.status()}
+        for key, pool in list(_pools.items())
+    ]
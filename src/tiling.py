@@ -0,0 +1,181 @@
+import torch
+
+from .image_handlers import resize_crop
+
+
+class Tile:
+    def __init__(self, x, y, width, height):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+
+    def __repr__(self):
+        return f"Tile({self.x}, {self.y}, {self.width}x{self.height})"
+
+
+def tile_starts(length, tile, overlap):
+    """
+    Start offsets of tiles covering length, each overlapping the next by at
+    least overlap. The last tile is moved back to end at length
+    """
+    if length <= tile:
+        return [0]
+
+    step = max(tile - overlap, 64)
+    starts = list(range(0, length - tile, step))
+    starts.append(length - tile)
+    return starts
+
+
+def tile_canvas(width, height, tile_width, tile_height, overlap) -> list[Tile]:
+    tile_width = min(tile_width, width)
+    tile_height = min(tile_height, height)
+    return [
+        Tile(x, y, tile_width, tile_height)
+        for y in tile_starts(height, tile_height, overlap)
+        for x in tile_starts(width, tile_width, overlap)
+    ]
+
+
+def fit_image(image: torch.Tensor | None, width, height):
+    """
+    Resizes a [B,H,W,C] image to the canvas the same way the request
+    encoding would, if it isn't that size already
+    """
+    if image is None:
+        return None
+    if image.size(dim=2) != width or image.size(dim=1) != height:
+        image = resize_crop(image, width, height)
+    return image
+
+
+def fit_mask(mask: torch.Tensor | None, width, height):
+    if mask is None:
+        return None
+    if mask.dim() == 2:
+        mask = mask.unsqueeze(0)
+    return fit_image(mask.unsqueeze(3), width, height)[:, :, :, 0]
+
+
+def fit_inputs(inputs: dict, width, height) -> dict:
+    """
+    The sampler inputs with the image, mask and hints resized to the canvas,
+    so each tile only has to crop them. Done once for the whole canvas, as
+    resizing an 8K image for every tile is slow and each resized copy would
+    be kept alive by the tiles cropped from it
+    """
+    fitted = dict(inputs)
+    fitted["image"] = fit_image(inputs.get("image"), width, height)
+    fitted["mask"] = fit_mask(inputs.get("mask"), width, height)
+
+    if inputs.get("hints"):
+        fitted["hints"] = [
+            {**hint, "image": fit_image(hint.get("image"), width, height)}
+            for hint in inputs["hints"]
+        ]
+    if inputs.get("control_net"):
+        fitted["control_net"] = [
+            {**cnet, "image": fit_image(cnet.get("image"), width, height)}
+            for cnet in inputs["control_net"]
+        ]
+
+    return fitted
+
+
+def crop_image(image: torch.Tensor | None, tile: Tile):
+    """
+    Crops tile out of a [B,H,W,C] image already fitted to the canvas
+    """
+    if image is None:
+        return None
+    return image[:, tile.y : tile.y + tile.height, tile.x : tile.x + tile.width, :]
+
+
+def crop_mask(mask: torch.Tensor | None, tile: Tile):
+    if mask is None:
+        return None
+    return mask[:, tile.y : tile.y + tile.height, tile.x : tile.x + tile.width]
+
+
+def tile_inputs(inputs: dict, tile: Tile) -> dict:
+    """
+    The sampler inputs for generating one tile of the canvas as its own
+    img2img request, with the image, mask and hints cropped to the tile.
+    inputs should have been through fit_inputs
+    """
+    tiled = dict(inputs)
+    tiled["width"] = tile.width
+    tiled["height"] = tile.height
+    tiled["tiled_diffusion"] = False
+    tiled["high_res_fix"] = False
+    tiled["image"] = crop_image(inputs.get("image"), tile)
+    tiled["mask"] = crop_mask(inputs.get("mask"), tile)
+
+    if inputs.get("hints"):
+        tiled["hints"] = [
+            {**hint, "image": crop_image(hint.get("image"), tile)}
+            for hint in inputs["hints"]
+        ]
+    if inputs.get("control_net"):
+        tiled["control_net"] = [
+            {**cnet, "image": crop_image(cnet.get("image"), tile)}
+            for cnet in inputs["control_net"]
+        ]
+
+    return tiled
+
+
+def blend_weights(tile: Tile, width, height, overlap) -> torch.Tensor:
+    """
+    [H,W] weights for a tile, ramping up across the overlap on each side
+    that borders another tile so neighbouring tiles cross fade
+    """
+
+    def ramp(length, start, end, total):
+        weights = torch.ones(length)
+        size = min(overlap, length // 2)
+        if size > 0:
+            rising = torch.arange(1, size + 1, dtype=torch.float32) / (size + 1)
+            if start > 0:
+                weights[:size] = rising
+            if end < total:
+                weights[-size:] = torch.minimum(weights[-size:], rising.flip(0))
+        return weights
+
+    rows = ramp(tile.height, tile.y, tile.y + tile.height, height)
+    columns = ramp(tile.width, tile.x, tile.x + tile.width, width)
+    return rows[:, None] * columns[None, :]
+
+
+def stitch_tiles(tiles: list[Tile], images: list[torch.Tensor], width, height, overlap):
+    """
+    Blends generated tiles back into one [B,H,W,C] canvas. If the server
+    returned the tiles at a different size (an upscaler), the canvas is
+    scaled to match
+    """
+    scale = images[0].size(dim=2) / tiles[0].width
+    canvas_width, canvas_height = round(width * scale), round(height * scale)
+    batch, _, _, channels = images[0].shape
+
+    canvas = torch.zeros((batch, canvas_height, canvas_width, channels))
+    total = torch.zeros((canvas_height, canvas_width, 1))
+
+    for tile, image in zip(tiles, images):
+        scaled = Tile(
+            round(tile.x * scale),
+            round(tile.y * scale),
+            image.size(dim=2),
+            image.size(dim=1),
+        )
+        weights = blend_weights(
+            scaled, canvas_width, canvas_height, round(overlap * scale)
+        )[:, :, None]
+        region = (
+            slice(scaled.y, scaled.y + scaled.height),
+            slice(scaled.x, scaled.x + scaled.width),
+        )
+        canvas[:, region[0], region[1], :] += image[:batch] * weights
+        total[region[0], region[1], :] += weights
+
+    return canvas / total.clamp(min=1e-6)
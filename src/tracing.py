@@ -0,0 +1,179 @@
+import collections
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .. import settings
+
+_trace_ids = itertools.count(1)
+
+
+class Trace:
+    """
+    The timeline of one sampler run, as Chrome trace events. Spans are put on
+    named tracks, which show up as threads in chrome://tracing and Perfetto
+    """
+
+    def __init__(self, name):
+        self.id = next(_trace_ids)
+        self.name = name
+        self.started_at = time.time()
+        self.origin = time.perf_counter()
+        self.events = []
+        self.tracks: dict[str, int] = {}
+        self.phases: dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def _timestamp(self, moment):
+        return (moment - self.origin) * 1_000_000
+
+    def add_span(self, name, started, ended, track="client", **args):
+        with self._lock:
+            tid = self.tracks.setdefault(track, len(self.tracks) + 1)
+            self.events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "pid": 1,
+                    "tid": tid,
+                    "ts": self._timestamp(started),
+                    "dur": (ended - started) * 1_000_000,
+                    "args": args,
+                }
+            )
+
+    @contextmanager
+    def span(self, name, track="client", **args):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(name, started, time.perf_counter(), track, **args)
+
+    def phase(self, track, name, **args):
+        """
+        Starts a new phase on track, ending the one before it. Used for the
+        server's signposts, which only say when the next phase begins. The
+        same phase again continues it
+        """
+        now = time.perf_counter()
+        current = self.phases.get(track)
+        if current is not None and current[0] == name:
+            return
+        self.phases.pop(track, None)
+        if current is not None:
+            self.add_span(current[0], current[1], now, track, **current[2])
+        if name is not None:
+            self.phases[track] = (name, now, args)
+
+    def end_phases(self):
+        for track in list(self.phases.keys()):
+            self.phase(track, None)
+
+    @property
+    def duration(self):
+        with self._lock:
+            return max((e["ts"] + e["dur"] for e in self.events), default=0) / 1000
+
+    def to_chrome(self):
+        with self._lock:
+            events = list(self.events)
+            tracks = dict(self.tracks)
+        metadata = [
+            {"name": "process_name", "ph": "M", "pid": 1, "args": {"name": self.name}}
+        ] + [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": 1,
+                "tid": tid,
+                "args": {"name": track},
+            }
+            for track, tid in tracks.items()
+        ]
+        return {
+            "traceEvents": metadata + events,
+            "displayTimeUnit": "ms",
+            "otherData": {"started_at": self.started_at},
+        }
+
+
+class NullTrace(Trace):
+    """
+    Stands in for a trace when tracing is off, recording nothing
+    """
+
+    def __init__(self):
+        super().__init__("")
+
+    def add_span(self, name, started, ended, track="client", **args):
+        pass
+
+    def phase(self, track, name, **args):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+class Tracer:
+    """
+    Keeps the most recent traces in a ring buffer, and writes each one to
+    settings.trace_dir as well if it is set
+    """
+
+    def __init__(self):
+        self._traces: collections.deque[Trace] = collections.deque()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return settings.trace or settings.trace_dir is not None
+
+    def start(self, name) -> Trace:
+        return Trace(name) if self.enabled else NULL_TRACE
+
+    def finish(self, trace: Trace):
+        if trace is NULL_TRACE:
+            return
+        trace.end_phases()
+
+        with self._lock:
+            self._traces.append(trace)
+            while len(self._traces) > max(settings.trace_buffer, 0):
+                self._traces.popleft()
+
+        if settings.trace_dir is not None:
+            try:
+                os.makedirs(settings.trace_dir, exist_ok=True)
+                stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(trace.started_at))
+                path = os.path.join(
+                    settings.trace_dir, f"dt_grpc-{stamp}-{trace.id}.json"
+                )
+                with open(path, "w") as file:
+                    json.dump(trace.to_chrome(), file)
+            except Exception as e:
+                print("DrawThings-gRPC couldn't write the trace file:", e)
+
+    def list(self):
+        with self._lock:
+            traces = list(self._traces)
+        return [
+            {
+                "id": trace.id,
+                "name": trace.name,
+                "started_at": trace.started_at,
+                "duration_ms": trace.duration,
+            }
+            for trace in traces
+        ]
+
+    def get(self, trace_id) -> Trace | None:
+        with self._lock:
+            return next((t for t in self._traces if t.id == trace_id), None)
+
+
+tracer = Tracer()
@@ -1,21 +1,122 @@
-class CancelRequest:
-    def __init__(self):
+import asyncio
+import os
+import threading
+from contextlib import contextmanager
+
+
+class CancelToken:
+    """
+    Cancellation for one generation. Callbacks registered with on_cancel run
+    on the event loop they were registered from, so cancel can be called from
+    any thread
+    """
+
+    def __init__(self, key=None):
+        self.key = key
         self.should_cancel = False
+        self._callbacks = []
 
     def cancel(self):
+        if self.should_cancel:
+            return
         self.should_cancel = True
+        for loop, callback in self._callbacks:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(callback)
 
-    def reset(self):
-        self.should_cancel = False
+    def on_cancel(self, callback):
+        loop = asyncio.get_running_loop()
+        if self.should_cancel:
+            loop.call_soon(callback)
+        else:
+            self._callbacks.append((loop, callback))
+
+    def raise_if_canceled(self):
+        if self.should_cancel:
+            raise Exception("canceled")
+
+
+class CancelRequests:
+    """
+    Keeps the cancel token of every generation in progress, keyed by the
+    sampler node's unique_id
+    """
+
+    def __init__(self):
+        self._tokens: dict[str, set[CancelToken]] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def scope(self, key):
+        token = CancelToken(str(key))
+        with self._lock:
+            self._tokens.setdefault(token.key, set()).add(token)
+        try:
+            yield token
+        finally:
+            with self._lock:
+                tokens = self._tokens.get(token.key, set())
+                tokens.discard(token)
+                if len(tokens) == 0:
+                    self._tokens.pop(token.key, None)
+
+    def cancel(self, key=None) -> int:
+        """
+        Cancels the generations for a unique_id, or every generation when no
+        key is given. Returns how many were canceled
+        """
+        with self._lock:
+            if key is None:
+                tokens = [t for key_tokens in self._tokens.values() for t in key_tokens]
+            else:
+                tokens = list(self._tokens.get(str(key), ()))
+
+        for token in tokens:
+            token.cancel()
+        return len(tokens)
 
 
 class Settings:
     def __init__(self):
         self.show_preview = True
+        self.codec_workers = try_parse_int(
+            os.environ.get("DT_GRPC_CODEC_WORKERS"), min(4, os.cpu_count() or 1)
+        )
+        self.content_addressed = os.environ.get("DT_GRPC_CONTENT_ADDRESSED") in [
+            "1",
+            "true",
+        ]
+        self.compress_uploads = os.environ.get("DT_GRPC_COMPRESS_UPLOADS") in [
+            "1",
+            "true",
+        ]
+        self.compress_uploads_threshold = try_parse_int(
+            os.environ.get("DT_GRPC_COMPRESS_UPLOADS_THRESHOLD"), 256 * 1024
+        )
+        self.batch_fan_out = os.environ.get("DT_GRPC_BATCH_FAN_OUT") in ["1", "true"]
+        self.distributed_tiling = os.environ.get("DT_GRPC_DISTRIBUTED_TILING") in [
+            "1",
+            "true",
+        ]
+        self.server_concurrency = max(
+            1, try_parse_int(os.environ.get("DT_GRPC_SERVER_CONCURRENCY"), 1)
+        )
+        self.interactive_slots = max(
+            0, try_parse_int(os.environ.get("DT_GRPC_INTERACTIVE_SLOTS"), 1)
+        )
+        self.interactive_max_pixels = try_parse_int(
+            os.environ.get("DT_GRPC_INTERACTIVE_MAX_PIXELS"), 1024 * 1024
+        )
+        self.max_queued_jobs = try_parse_int(
+            os.environ.get("DT_GRPC_MAX_QUEUED_JOBS"), 1024
+        )
+        self.trace = os.environ.get("DT_GRPC_TRACE") in ["1", "true"]
+        self.trace_dir = os.environ.get("DT_GRPC_TRACE_DIR") or None
+        self.trace_buffer = try_parse_int(os.environ.get("DT_GRPC_TRACE_BUFFER"), 20)
 
 
 def try_parse_int(value, default=0):
     try:
         return int(value)
-    except ValueError:
+    except (TypeError, ValueError):
         return default
@@ -11,14 +11,20 @@ var __privateMethod = (obj, member, method) => (__accessCheck(obj, member, "acce
 
 // web/src/models.ts
 var app2 = window.comfyAPI.app.app;
-var _updateNodesPromise, _ModelService_instances, updateNodes_fn;
+var _updateNodesPromise, _refresh, _ModelService_instances, updateNodes_fn;
 var ModelService = class {
   constructor() {
     __privateAdd(this, _ModelService_instances);
     __privateAdd(this, _updateNodesPromise, null);
+    __privateAdd(this, _refresh, false);
   }
-  async updateNodes() {
+  /**
+   * @param refresh ask the servers for their current models instead of a
+   * cached list, for retries and server changes
+   */
+  async updateNodes(refresh = false) {
     if (app2.configuringGraph || !app2.graph) return;
+    if (refresh) __privateSet(this, _refresh, true);
     if (!__privateGet(this, _updateNodesPromise)) {
       __privateSet(this, _updateNodesPromise, new Promise((res) => {
         setTimeout(() => {
@@ -31,8 +37,11 @@ var ModelService = class {
   }
 };
 _updateNodesPromise = new WeakMap();
+_refresh = new WeakMap();
 _ModelService_instances = new WeakSet();
 updateNodes_fn = async function() {
+  const refresh = __privateGet(this, _refresh);
+  __privateSet(this, _refresh, false);
   const dtModelNodes = getNodesRecursive(app2.graph).filter(
     (n) => n.isDtServerNode !== void 0
   );
@@ -47,7 +56,7 @@ updateNodes_fn = async function() {
     if (!server || !port || useTls === void 0) continue;
     const key = modelInfoStoreKey(server, port, useTls);
     if (!serverModels.has(key)) {
-      serverModels.set(key, await getModels(server, port, useTls));
+      serverModels.set(key, await getModels(server, port, useTls, refresh));
     }
     const models2 = serverModels.get(key);
     sn.updateModels?.(models2);
@@ -98,7 +107,7 @@ function DtModelTypeHandler(node, inputName, inputData, app6) {
     /** @type WidgetCallback<IWidget<any, any>> */
     ((value, graph, node2) => {
       node2.saveSelectedModels?.();
-      modelService.updateNodes();
+      modelService.updateNodes(value === "Click to retry");
     }),
     {
       values: ["(None selected)"],
@@ -107,11 +116,12 @@ function DtModelTypeHandler(node, inputName, inputData, app6) {
   );
   return { widget };
 }
-async function getFiles(server, port, useTls) {
+async function getFiles(server, port, useTls, refresh = false) {
   const body = new FormData();
   body.append("server", server);
   body.append("port", String(port));
   body.append("use_tls", String(useTls));
+  if (refresh) body.append("refresh", "true");
   const api = window.comfyAPI.api.api;
   const filesInfoResponse = await api.fetchApi(`/dt_grpc/files_info`, {
     method: "POST",
@@ -190,7 +200,7 @@ var notConnectedOptions = [
   file: "",
   version: "fail"
 }));
-async function getModels(server, port, useTls) {
+async function getModels(server, port, useTls, refresh = false) {
   if (!server || !port || useTls === void 0) return;
   if (app2.extensionManager.setting.get("drawthings.bridge_mode.enabled"))
     return getBridgeModels();
@@ -200,7 +210,7 @@ async function getModels(server, port, useTls) {
     await request;
   } else {
     const promise = new Promise((resolve) => {
-      getFiles(server, port, useTls).then(async (response) => {
+      getFiles(server, port, useTls, refresh).then(async (response) => {
         if (!response.ok) {
           modelInfoStore.set(key, null);
         } else {
@@ -1885,13 +1895,13 @@ var dtServerNodeProto = {
   onNodeCreated() {
     const serverWidget = this.widgets?.find((w) => w.name === "server");
     if (serverWidget)
-      setCallback2(serverWidget, "callback", () => modelService.updateNodes());
+      setCallback2(serverWidget, "callback", () => modelService.updateNodes(true));
     const portWidget = this.widgets?.find((w) => w.name === "port");
     if (portWidget)
-      setCallback2(portWidget, "callback", () => modelService.updateNodes());
+      setCallback2(portWidget, "callback", () => modelService.updateNodes(true));
     const tlsWidget = this.widgets?.find((w) => w.name === "use_tls");
     if (tlsWidget)
-      setCallback2(tlsWidget, "callback", () => modelService.updateNodes());
+      setCallback2(tlsWidget, "callback", () => modelService.updateNodes(true));
   },
   getServer() {
     const server = this.widgets?.find((w) => w.name === "server")?.value;
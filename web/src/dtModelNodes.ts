@@ -154,15 +154,15 @@ const dtServerNodeProto: any = {
 		// update when server or port changes
 		const serverWidget = this.widgets?.find((w) => w.name === "server");
 		if (serverWidget)
-			setCallback(serverWidget, "callback", () => modelService.updateNodes());
+			setCallback(serverWidget, "callback", () => modelService.updateNodes(true));
 
 		const portWidget = this.widgets?.find((w) => w.name === "port");
 		if (portWidget)
-			setCallback(portWidget, "callback", () => modelService.updateNodes());
+			setCallback(portWidget, "callback", () => modelService.updateNodes(true));
 
 		const tlsWidget = this.widgets?.find((w) => w.name === "use_tls");
 		if (tlsWidget)
-			setCallback(tlsWidget, "callback", () => modelService.updateNodes());
+			setCallback(tlsWidget, "callback", () => modelService.updateNodes(true));
 	},
 
 	getServer(this: DTServerNode) {
@@ -28,12 +28,18 @@ interface DTModelNode extends LGraphNode {
 
 class ModelService {
 	#updateNodesPromise: Promise<void> | null = null;
+	#refresh = false;
 
 	constructor() {}
 
-	async updateNodes() {
+	/**
+	 * @param refresh ask the servers for their current models instead of a
+	 * cached list, for retries and server changes
+	 */
+	async updateNodes(refresh = false) {
 		// since many nodes may be configured at once, we will batch calls to updateNodes
 		if (app.configuringGraph || !app.graph) return;
+		if (refresh) this.#refresh = true;
 		if (!this.#updateNodesPromise) {
 			this.#updateNodesPromise = new Promise((res) => {
 				setTimeout(() => {
@@ -47,6 +53,8 @@ class ModelService {
 	}
 
 	async #updateNodes() {
+		const refresh = this.#refresh;
+		this.#refresh = false;
 		const dtModelNodes = getNodesRecursive(app.graph).filter(
 			(n: any) => n.isDtServerNode !== undefined,
 		) as DTModelNode[];
@@ -65,7 +73,7 @@ class ModelService {
 			if (!server || !port || useTls === undefined) continue;
 			const key = modelInfoStoreKey(server, port, useTls);
 			if (!serverModels.has(key)) {
-				serverModels.set(key, await getModels(server, port, useTls));
+				serverModels.set(key, await getModels(server, port, useTls, refresh));
 			}
 
 			// update server node's models
@@ -145,7 +153,7 @@ export function DtModelTypeHandler(
 		(
 			(value: any, graph: any, node: any) => {
 				node.saveSelectedModels?.();
-				modelService.updateNodes();
+				modelService.updateNodes(value === "Click to retry");
 			}
 		) as any,
 		{
@@ -165,11 +173,13 @@ export async function getFiles(
 	server: string,
 	port: number | string,
 	useTls: boolean,
+	refresh = false,
 ) {
 	const body = new FormData();
 	body.append("server", server);
 	body.append("port", String(port));
 	body.append("use_tls", String(useTls));
+	if (refresh) body.append("refresh", "true");
 
 	const api = window.comfyAPI.api.api;
 	const filesInfoResponse = await api.fetchApi(`/dt_grpc/files_info`, {
@@ -296,6 +306,7 @@ async function getModels(
 	server: string,
 	port: number | string,
 	useTls: boolean,
+	refresh = false,
 ) {
 	if (!server || !port || useTls === undefined) return;
 	if (app.extensionManager.setting.get("drawthings.bridge_mode.enabled"))
@@ -307,7 +318,7 @@ async function getModels(
 		await request;
 	} else {
 		const promise = new Promise<void>((resolve) => {
-			getFiles(server, port, useTls).then(async (response) => {
+			getFiles(server, port, useTls, refresh).then(async (response) => {
 				if (!response.ok) {
 					modelInfoStore.set(key, null);
 				} else {